@@ -1,8 +1,19 @@
 import abc
+import base64
 import concurrent.futures
 import dataclasses
+import functools
+import hashlib
+import json
+import multiprocessing
 import os
+import queue
+import socket
+import socketserver
 import subprocess
+import tempfile
+import threading
+import time
 import typing
 
 import numpy as np
@@ -59,11 +70,453 @@ class PageToPlayerDataList(core_converters.abc.Converter):
         return player_data_list
 
 
+class RenderJobError(Exception):
+    def __init__(self, render_job: "RenderJob", reason: str):
+        super().__init__(
+            f"Render job {render_job.job_index} with template "
+            f"'{render_job.template_path}' failed "
+            f"{render_job.attempt_count} time(s).\n"
+            f"Last reason: {reason}"
+        )
+
+
+# Raised by a worker whose node can't render any job (in contrast
+# to a job which can't be rendered, see 'RenderJobError').
+class RenderWorkerError(Exception):
+    ...
+
+
+class TemplateMismatchError(RenderWorkerError):
+    def __init__(self, template_path: str, expected_hash: str, local_hash: str):
+        super().__init__(
+            f"The local template '{template_path}' differs from the "
+            "template of the render job.\n"
+            f"Expected hash: {expected_hash}; local hash: {local_hash}. "
+            "Please synchronize the templates of all render workers."
+        )
+
+
+class NoRenderWorkerError(Exception):
+    def __init__(self, address: tuple[str, int], worker_timeout: float):
+        host, port = address
+        super().__init__(
+            f"No render worker has been connected to {host}:{port} "
+            f"for {worker_timeout} seconds.\n"
+            f"Start workers with 'scripts/render-worker {host} {port}' "
+            "or set 'local_worker_count' to a value bigger than 0."
+        )
+
+
+def _get_template_hash(template_path: str) -> str:
+    with open(template_path, "rb") as template_file:
+        return hashlib.sha256(template_file.read()).hexdigest()
+
+
+def _send_message(file: typing.BinaryIO, message: dict):
+    file.write(json.dumps(message).encode("utf-8") + b"\n")
+    file.flush()
+
+
+def _receive_message(file: typing.BinaryIO) -> typing.Optional[dict]:
+    line = file.readline()
+    # Empty line means the other side closed the connection.
+    if not line:
+        return None
+    return json.loads(line)
+
+
+@dataclasses.dataclass
+class RenderJob(object):
+    job_index: int
+    template_path: str
+    template_hash: str
+    template_argument_dict: dict[str, typing.Any]
+    attempt_count: int = 0
+
+    # The serialized job is sent as JSON. JSON has no tuples, so
+    # tuples inside 'template_argument_dict' (for instance the
+    # 'player_data_list' of a page) arrive as lists on the worker side.
+    # Jinja2 templates index lists and tuples in the same way.
+    def serialize(self) -> dict:
+        return dataclasses.asdict(self)
+
+    @classmethod
+    def deserialize(cls, serialized_render_job: dict) -> "RenderJob":
+        return cls(**serialized_render_job)
+
+
+class RenderWorker(object):
+    # Renders jobs of a 'RenderJobQueue' until the queue sends 'stop'.
+    # If the queue isn't listening yet or the connection is lost, the
+    # worker tries to (re)connect for 'connection_timeout' seconds.
+    # Workers can run on other nodes, as long as they are started
+    # inside a checkout of this repository (see 'scripts/render-worker').
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        connection_timeout: float = constants.RENDER_WORKER_CONNECTION_TIMEOUT,
+    ):
+        self.address = address
+        self.connection_timeout = connection_timeout
+
+    # Lazy, so that the worker can be sent to a new process
+    # before the environment exists.
+    @functools.cached_property
+    def environment(self) -> jinja2.Environment:
+        return jinja2.Environment(loader=jinja2.FileSystemLoader("./"))
+
+    def render(self, render_job: RenderJob) -> bytes:
+        # Workers outside of the repository root don't find the templates.
+        try:
+            local_template_hash = _get_template_hash(render_job.template_path)
+            template = self.environment.get_template(render_job.template_path)
+        except (OSError, jinja2.TemplateNotFound) as error:
+            raise RenderWorkerError(
+                f"Can't load template '{render_job.template_path}': {error!r}"
+            )
+        if local_template_hash != render_job.template_hash:
+            raise TemplateMismatchError(
+                render_job.template_path, render_job.template_hash, local_template_hash
+            )
+        tex_file_content = template.render(**render_job.template_argument_dict)
+        with tempfile.TemporaryDirectory() as directory:
+            tex_path = os.path.join(directory, "page.tex")
+            with open(tex_path, "w") as tex_file:
+                tex_file.write(tex_file_content)
+            try:
+                return_code = subprocess.call(
+                    [
+                        "lualatex",
+                        f"--output-directory={directory}",
+                        "--output-format=pdf",
+                        "-interaction=batchmode",
+                        tex_path,
+                    ],
+                    stdout=subprocess.DEVNULL,
+                )
+            except FileNotFoundError as error:
+                raise RenderWorkerError(f"Can't call 'lualatex': {error}")
+            pdf_path = os.path.join(directory, "page.pdf")
+            # The tex file is rendered from our own templates, so if
+            # 'lualatex' fails, the TeX installation of the node is broken.
+            if not os.path.exists(pdf_path):
+                raise RenderWorkerError(
+                    f"'lualatex' exited with {return_code} and created no pdf."
+                )
+            with open(pdf_path, "rb") as pdf_file:
+                return pdf_file.read()
+
+    def _get_reply(self, render_job: RenderJob) -> dict:
+        reply = {"job_index": render_job.job_index}
+        try:
+            pdf = self.render(render_job)
+        # Any 'OSError' (a full disk, a missing temporary directory, ...)
+        # is a problem of the node, not of the job.
+        except (RenderWorkerError, OSError) as error:
+            reply.update(error=repr(error), error_kind="worker")
+        except Exception as error:
+            reply.update(error=repr(error), error_kind="job")
+        else:
+            reply.update(pdf=base64.b64encode(pdf).decode("ascii"))
+        return reply
+
+    def _connect(self) -> socket.socket:
+        deadline = time.monotonic() + self.connection_timeout
+        delay = 0.1
+        while True:
+            try:
+                return socket.create_connection(self.address)
+            except OSError:
+                if time.monotonic() + delay > deadline:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    # Returns 'True' if the queue sent 'stop' and 'False'
+    # if the connection has been lost.
+    def _render_until_stop(self, connection: socket.socket) -> bool:
+        with connection, connection.makefile("rwb") as file:
+            try:
+                while (message := _receive_message(file)) is not None:
+                    if "job" not in message:
+                        return True
+                    render_job = RenderJob.deserialize(message["job"])
+                    _send_message(file, self._get_reply(render_job))
+            except (OSError, ValueError):
+                pass
+        return False
+
+    def run(self):
+        while not self._render_until_stop(self._connect()):
+            pass
+
+
+class _RenderJobServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _RenderJobBatch(object):
+    # State of one 'RenderJobQueue.render' call.
+
+    def __init__(
+        self, render_job_tuple: tuple[RenderJob, ...], maxima_attempt_count: int
+    ):
+        self.pending_render_job_queue = queue.Queue()
+        for render_job in render_job_tuple:
+            self.pending_render_job_queue.put(render_job)
+        self.render_job_count = len(render_job_tuple)
+        self.maxima_attempt_count = maxima_attempt_count
+        self.pdf_dict = {}
+        self.error = None
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def requeue(self, render_job: RenderJob):
+        self.pending_render_job_queue.put(render_job)
+
+    def retry(self, render_job: RenderJob, reason: str):
+        render_job.attempt_count += 1
+        if render_job.attempt_count >= self.maxima_attempt_count:
+            with self.lock:
+                if self.error is None:
+                    self.error = RenderJobError(render_job, reason)
+            self.finished.set()
+        else:
+            self.requeue(render_job)
+
+    def add_pdf(self, render_job: RenderJob, pdf: bytes):
+        with self.lock:
+            self.pdf_dict[render_job.job_index] = pdf
+            if len(self.pdf_dict) == self.render_job_count:
+                self.finished.set()
+
+
+class RenderJobQueue(object):
+    # Use the queue as a context manager: workers can connect from
+    # entering until leaving the context, so the same workers render
+    # all 'render' calls in between (for instance one call per voice
+    # count). The bound address is printed, because remote workers
+    # need it (see 'scripts/render-worker').
+    #
+    # Each worker gets one job at a time. If a worker disconnects or
+    # doesn't answer within 'timeout' seconds, its job is put back into
+    # the queue and another worker renders it. Crashed local workers are
+    # restarted. A job which fails 'maxima_attempt_count' times raises
+    # 'RenderJobError'. A worker whose node can't render (for instance
+    # because of a different template) is dropped without counting an
+    # attempt. If no worker is connected for 'worker_timeout' seconds,
+    # 'render' raises 'NoRenderWorkerError'.
+
+    def __init__(
+        self,
+        local_worker_count: typing.Optional[int] = None,
+        address: tuple[str, int] = constants.RENDER_JOB_QUEUE_ADDRESS,
+        maxima_attempt_count: int = constants.RENDER_JOB_MAXIMA_ATTEMPT_COUNT,
+        timeout: float = constants.RENDER_JOB_TIMEOUT,
+        worker_timeout: float = constants.RENDER_JOB_QUEUE_WORKER_TIMEOUT,
+    ):
+        if local_worker_count is None:
+            local_worker_count = os.cpu_count() or 1
+        self.local_worker_count = local_worker_count
+        self.address = address
+        self.maxima_attempt_count = maxima_attempt_count
+        self.timeout = timeout
+        self.worker_timeout = worker_timeout
+        self._server = None
+        self._batch = None
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self._connected_worker_count = 0
+        self._active_local_worker_count = 0
+        self._process_list = []
+
+    def __enter__(self) -> "RenderJobQueue":
+        render_job_queue = self
+
+        class RenderJobRequestHandler(socketserver.StreamRequestHandler):
+            timeout = self.timeout
+
+            def handle(self):
+                render_job_queue._serve_worker(self.rfile, self.wfile)
+
+        self._closed.clear()
+        self._server = _RenderJobServer(self.address, RenderJobRequestHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        host, port = self.bound_address
+        print(f"Render job queue waits for workers on {host}:{port}.")
+        self._active_local_worker_count = self.local_worker_count
+        self._maintain_local_worker_list()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def bound_address(self) -> tuple[str, int]:
+        return self._server.server_address[:2]
+
+    def close(self):
+        if self._server is None:
+            return
+        self._closed.set()
+        for process in self._process_list:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        self._process_list = []
+        # Give remote workers time to receive 'stop'.
+        deadline = time.monotonic() + 1
+        while self._connected_worker_count and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+
+    def _maintain_local_worker_list(self):
+        alive_process_list = []
+        for process in self._process_list:
+            if process.is_alive():
+                alive_process_list.append(process)
+                continue
+            process.join()
+            # Only dropped workers exit cleanly while the queue is open.
+            # Restarting them would fail again, so only crashed workers
+            # are replaced.
+            if process.exitcode == 0:
+                self._active_local_worker_count -= 1
+        self._process_list = alive_process_list
+        worker = RenderWorker(self.bound_address)
+        # The server thread already runs, and forking a process with
+        # threads may deadlock the child. Note that 'spawn' imports the
+        # main module again, so scripts need a '__main__' guard.
+        context = multiprocessing.get_context("spawn")
+        while len(self._process_list) < self._active_local_worker_count:
+            process = context.Process(target=worker.run, daemon=True)
+            process.start()
+            self._process_list.append(process)
+
+    def _get_render_job(
+        self,
+    ) -> typing.Optional[tuple[_RenderJobBatch, RenderJob]]:
+        while not self._closed.is_set():
+            batch = self._batch
+            if batch is None or batch.finished.is_set():
+                self._closed.wait(timeout=0.1)
+                continue
+            try:
+                return batch, batch.pending_render_job_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _serve_worker(self, rfile: typing.BinaryIO, wfile: typing.BinaryIO):
+        with self._lock:
+            self._connected_worker_count += 1
+        try:
+            self._serve_connected_worker(rfile, wfile)
+        finally:
+            with self._lock:
+                self._connected_worker_count -= 1
+
+    # Returns 'False' if the worker shall be dropped.
+    def _dispatch_render_job(
+        self,
+        batch: _RenderJobBatch,
+        render_job: RenderJob,
+        rfile: typing.BinaryIO,
+        wfile: typing.BinaryIO,
+    ) -> bool:
+        _send_message(wfile, {"job": render_job.serialize()})
+        message = _receive_message(rfile)
+        if message is None:
+            raise ConnectionError("Lost connection to worker.")
+        error_kind = message.get("error_kind")
+        if error_kind == "worker":
+            # It's not the fault of the job, so another worker
+            # takes it over and this worker is dropped.
+            print(f"Drop render worker: {message['error']}")
+            batch.requeue(render_job)
+            return False
+        elif error_kind == "job":
+            batch.retry(render_job, message["error"])
+        else:
+            batch.add_pdf(render_job, base64.b64decode(message["pdf"]))
+        return True
+
+    def _serve_connected_worker(self, rfile: typing.BinaryIO, wfile: typing.BinaryIO):
+        while (batch_and_render_job := self._get_render_job()) is not None:
+            batch, render_job = batch_and_render_job
+            # Whatever goes wrong (lost connection, malformed reply, ...),
+            # the job must not get lost, otherwise 'render' would wait
+            # forever.
+            try:
+                keep_worker = self._dispatch_render_job(
+                    batch, render_job, rfile, wfile
+                )
+            except socket.timeout:
+                batch.retry(render_job, "Worker didn't reply in time.")
+                return
+            # The worker died (maybe already while it was idle), which
+            # isn't the fault of the job: don't count an attempt.
+            except OSError:
+                batch.requeue(render_job)
+                return
+            except Exception as error:
+                batch.retry(render_job, repr(error))
+                return
+            if not keep_worker:
+                break
+        try:
+            _send_message(wfile, {"stop": True})
+        except OSError:
+            pass
+
+    def render(
+        self, render_job_sequence: typing.Sequence[RenderJob]
+    ) -> tuple[bytes, ...]:
+        if self._server is None:
+            with self:
+                return self.render(render_job_sequence)
+
+        render_job_tuple = tuple(render_job_sequence)
+        if not render_job_tuple:
+            return tuple()
+
+        batch = _RenderJobBatch(render_job_tuple, self.maxima_attempt_count)
+        self._batch = batch
+        last_worker_time = time.monotonic()
+        try:
+            while not batch.finished.wait(timeout=0.5):
+                self._maintain_local_worker_list()
+                if self._connected_worker_count:
+                    last_worker_time = time.monotonic()
+                elif time.monotonic() - last_worker_time > self.worker_timeout:
+                    raise NoRenderWorkerError(
+                        self.bound_address, self.worker_timeout
+                    )
+        finally:
+            self._batch = None
+
+        if batch.error is not None:
+            raise batch.error
+
+        return tuple(
+            batch.pdf_dict[render_job.job_index] for render_job in render_job_tuple
+        )
+
+
 class Jinja2Converter(core_converters.abc.Converter):
     def __init__(self, template_path: str):
         environment = jinja2.Environment(loader=jinja2.FileSystemLoader("./"))
+        self.template_path = template_path
         self.template = environment.get_template(template_path)
 
+    @functools.cached_property
+    def template_hash(self) -> str:
+        return _get_template_hash(self.template_path)
+
     @abc.abstractmethod
     def _get_default_path(self, *args, **kwargs) -> str:
         ...
@@ -108,15 +561,32 @@ class PageToPDF(Jinja2Converter):
         voice_count = len(page_to_convert)
         return f"{constants.BUILD_PATH}/{voice_count}_{page_to_convert.page_number}"
 
+    def _get_template_argument_dict(
+        self, page_to_convert: pages_events.Page
+    ) -> dict[str, typing.Any]:
+        player_data_list = self.page_to_player_data_list.convert(page_to_convert)
+        return dict(
+            player_data_list=player_data_list, page_number=page_to_convert.page_number
+        )
+
     def _get_tex_file_content(
         self, page_to_convert: pages_events.Page, **kwargs
     ) -> str:
-        player_data_list = self.page_to_player_data_list.convert(page_to_convert)
         tex_file_content = self.template.render(
-            player_data_list=player_data_list, page_number=page_to_convert.page_number
+            **self._get_template_argument_dict(page_to_convert)
         )
         return tex_file_content
 
+    def get_render_job(
+        self, page_to_convert: pages_events.Page, job_index: int
+    ) -> RenderJob:
+        return RenderJob(
+            job_index,
+            self.template_path,
+            self.template_hash,
+            self._get_template_argument_dict(page_to_convert),
+        )
+
 
 class VoiceCountToPageCover(Jinja2Converter):
     def __init__(self):
@@ -133,21 +603,17 @@ class VoiceCountToPageCover(Jinja2Converter):
 
 
 class PageSequentialEventToPDF(core_converters.abc.Converter):
-    def __init__(self):
+    def __init__(self, render_job_queue: typing.Optional[RenderJobQueue] = None):
         self.page_to_pdf = PageToPDF()
+        self.render_job_queue = render_job_queue
 
-    def convert(
+    def _convert_pages_locally(
         self,
         page_sequential_event_to_convert: core_events.SequentialEvent[
             pages_events.Page
         ],
-        path: typing.Optional[str] = None,
-        cleanup: bool = True,
-    ) -> str:
-        voice_count = len(page_sequential_event_to_convert[0])
-        cover_path = VoiceCountToPageCover().convert(voice_count, cleanup=cleanup)
-        if path is None:
-            path = f"{constants.BUILD_PATH}/pages_for_{voice_count}_players.pdf"
+        cleanup: bool,
+    ) -> list[str]:
         with concurrent.futures.ThreadPoolExecutor() as executor:
             future_list = []
             for page in page_sequential_event_to_convert:
@@ -156,7 +622,47 @@ class PageSequentialEventToPDF(core_converters.abc.Converter):
                 )
                 future_list.append(future)
 
-            path_list = [future.result() for future in future_list]
+            return [future.result() for future in future_list]
+
+    def _convert_pages_with_render_job_queue(
+        self,
+        page_sequential_event_to_convert: core_events.SequentialEvent[
+            pages_events.Page
+        ],
+    ) -> list[str]:
+        render_job_list = [
+            self.page_to_pdf.get_render_job(page, job_index)
+            for job_index, page in enumerate(page_sequential_event_to_convert)
+        ]
+        pdf_tuple = self.render_job_queue.render(render_job_list)
+        path_list = []
+        for page, pdf in zip(page_sequential_event_to_convert, pdf_tuple):
+            page_path = f"{self.page_to_pdf._get_default_path(page)}.pdf"
+            with open(page_path, "wb") as pdf_file:
+                pdf_file.write(pdf)
+            path_list.append(page_path)
+        return path_list
+
+    def convert(
+        self,
+        page_sequential_event_to_convert: core_events.SequentialEvent[
+            pages_events.Page
+        ],
+        path: typing.Optional[str] = None,
+        cleanup: bool = True,
+    ) -> str:
+        voice_count = len(page_sequential_event_to_convert[0])
+        cover_path = VoiceCountToPageCover().convert(voice_count, cleanup=cleanup)
+        if path is None:
+            path = f"{constants.BUILD_PATH}/pages_for_{voice_count}_players.pdf"
+        if self.render_job_queue is None:
+            path_list = self._convert_pages_locally(
+                page_sequential_event_to_convert, cleanup
+            )
+        else:
+            path_list = self._convert_pages_with_render_job_queue(
+                page_sequential_event_to_convert
+            )
 
         path_list.insert(0, cover_path)
         subprocess.call(["pdftk"] + path_list + ["output", path])
@@ -17,3 +17,17 @@ MAXIMA_DURATION_GENERATOR_ENVELOPE = core_events.Envelope([[0, 0.65], [10, 1], [
 MAXIMA_DURATION_GENERATOR_OFFSET = 10
 
 PARTY_COUNT_TUPLE = (3, 4, 5)
+
+# Render job queue
+# Port '0' lets the operating system pick a free port. If workers
+# on other nodes should join, bind to a reachable address instead
+# (for instance ("0.0.0.0", 8765)).
+RENDER_JOB_QUEUE_ADDRESS = ("localhost", 0)
+RENDER_JOB_MAXIMA_ATTEMPT_COUNT = 3
+# Seconds the queue waits for a worker to return a rendered page
+# before it declares the worker as lost.
+RENDER_JOB_TIMEOUT = 600
+# Seconds 'RenderJobQueue.render' waits if no worker is connected.
+RENDER_JOB_QUEUE_WORKER_TIMEOUT = 60
+# Seconds a worker tries to (re)connect to the queue.
+RENDER_WORKER_CONNECTION_TIMEOUT = 60
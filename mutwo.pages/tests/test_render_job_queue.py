@@ -0,0 +1,242 @@
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import unittest
+
+import ranges
+
+from mutwo import pages_converters
+from mutwo import pages_events
+
+# Copies the tex file to the pdf file, so that each rendered
+# 'pdf' contains the page number of its page.
+FAKE_LUALATEX = """#!/bin/sh
+for argument in "$@"; do
+    case "$argument" in
+        --output-directory=*) directory="${argument#--output-directory=}" ;;
+    esac
+    tex_path="$argument"
+done
+if [ -n "$FAKE_LUALATEX_FAIL" ]; then
+    exit 1
+fi
+if rm "$FAKE_LUALATEX_KILL_MARKER" 2>/dev/null; then
+    kill -9 $PPID
+    exit 1
+fi
+if rm "$FAKE_LUALATEX_SLEEP_MARKER" 2>/dev/null; then
+    sleep 5
+fi
+cp "$tex_path" "$directory/$(basename "$tex_path" .tex).pdf"
+"""
+
+
+def _run_worker(directory: str, address: tuple[str, int]):
+    os.chdir(directory)
+    pages_converters.RenderWorker(address, connection_timeout=5).run()
+
+
+def _reply_without_pdf(connection: socket.socket):
+    with connection, connection.makefile("rwb") as file:
+        message = json.loads(file.readline())
+        file.write(
+            json.dumps({"job_index": message["job"]["job_index"]}).encode() + b"\n"
+        )
+        file.flush()
+        # Wait until the queue closes the connection.
+        file.read()
+
+
+def _get_free_port() -> int:
+    with socket.socket() as free_socket:
+        free_socket.bind(("localhost", 0))
+        return free_socket.getsockname()[1]
+
+
+class RenderJobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        self.cwd = os.getcwd()
+
+        bin_directory = os.path.join(self.directory, "bin")
+        os.mkdir(bin_directory)
+        lualatex_path = os.path.join(bin_directory, "lualatex")
+        with open(lualatex_path, "w") as lualatex_file:
+            lualatex_file.write(FAKE_LUALATEX)
+        os.chmod(lualatex_path, os.stat(lualatex_path).st_mode | stat.S_IEXEC)
+        os.environ["PATH"] = f"{bin_directory}{os.pathsep}{os.environ['PATH']}"
+
+        # 'fail.missing.attribute' raises an error, so that
+        # jobs can fail independently of the worker.
+        self._write_template(
+            self.directory,
+            "{{ page_number }}{% if fail %}{{ fail.missing.attribute }}{% endif %}",
+        )
+        self.empty_directory = os.path.join(self.directory, "empty")
+        os.mkdir(self.empty_directory)
+        self.broken_directory = os.path.join(self.directory, "broken")
+        self._write_template(self.broken_directory, "old {{ page_number }}")
+
+        os.chdir(self.directory)
+        self.page_to_pdf = pages_converters.PageToPDF()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def _write_template(self, directory: str, template: str):
+        templates_directory = os.path.join(directory, "templates")
+        os.makedirs(templates_directory)
+        with open(os.path.join(templates_directory, "page.tex.j2"), "w") as file:
+            file.write(template)
+
+    def _set_marker(self, name: str):
+        marker_path = os.path.join(self.directory, name)
+        open(marker_path, "w").close()
+        os.environ[name] = marker_path
+
+    def _start_worker(
+        self, directory: str, address: tuple[str, int]
+    ) -> multiprocessing.Process:
+        process = multiprocessing.get_context("spawn").Process(
+            target=_run_worker, args=(directory, address), daemon=True
+        )
+        process.start()
+        return process
+
+    def _get_render_job_list(
+        self, page_count: int
+    ) -> list[pages_converters.RenderJob]:
+        render_job_list = []
+        for page_number in range(page_count):
+            page = pages_events.Page(
+                [
+                    pages_events.EventSequence(
+                        player_index=0,
+                        event_count=1,
+                        event_duration_range=ranges.Range(5, 10),
+                    )
+                ],
+                page_number=page_number,
+            )
+            render_job_list.append(
+                self.page_to_pdf.get_render_job(page, page_number)
+            )
+        return render_job_list
+
+    def _get_expected_pdf_tuple(self, page_count: int) -> tuple[bytes, ...]:
+        return tuple(str(page_number).encode() for page_number in range(page_count))
+
+    def test_render_in_order(self):
+        self.assertEqual(
+            pages_converters.RenderJobQueue(3).render(self._get_render_job_list(20)),
+            self._get_expected_pdf_tuple(20),
+        )
+
+    def test_render_with_remote_worker_over_multiple_calls(self):
+        address = ("localhost", _get_free_port())
+        # Worker is started before the queue listens.
+        process = self._start_worker(self.directory, address)
+        with pages_converters.RenderJobQueue(0, address=address) as render_job_queue:
+            for page_count in (3, 5):
+                self.assertEqual(
+                    render_job_queue.render(self._get_render_job_list(page_count)),
+                    self._get_expected_pdf_tuple(page_count),
+                )
+        process.join(timeout=5)
+        self.assertEqual(process.exitcode, 0)
+
+    def test_redispatch_after_killed_worker(self):
+        self._set_marker("FAKE_LUALATEX_KILL_MARKER")
+        # Losing a worker doesn't count as a failed attempt of its job.
+        render_job_queue = pages_converters.RenderJobQueue(2, maxima_attempt_count=1)
+        self.assertEqual(
+            render_job_queue.render(self._get_render_job_list(10)),
+            self._get_expected_pdf_tuple(10),
+        )
+        self.assertFalse(os.path.exists(os.environ["FAKE_LUALATEX_KILL_MARKER"]))
+
+    def test_redispatch_after_timeout(self):
+        self._set_marker("FAKE_LUALATEX_SLEEP_MARKER")
+        self.assertEqual(
+            pages_converters.RenderJobQueue(2, timeout=1).render(
+                self._get_render_job_list(10)
+            ),
+            self._get_expected_pdf_tuple(10),
+        )
+        self.assertFalse(os.path.exists(os.environ["FAKE_LUALATEX_SLEEP_MARKER"]))
+
+    def test_malformed_reply(self):
+        with pages_converters.RenderJobQueue(1) as render_job_queue:
+            # A worker which replies without a pdf. It's connected before
+            # the local worker has been started, so it gets the first job.
+            connection = socket.create_connection(render_job_queue.bound_address)
+            thread = threading.Thread(target=_reply_without_pdf, args=(connection,))
+            thread.start()
+            self.assertEqual(
+                render_job_queue.render(self._get_render_job_list(3)),
+                self._get_expected_pdf_tuple(3),
+            )
+            thread.join(timeout=5)
+            self.assertFalse(thread.is_alive())
+
+    def test_template_mismatch_drops_worker(self):
+        with pages_converters.RenderJobQueue(2) as render_job_queue:
+            process = self._start_worker(
+                self.broken_directory, render_job_queue.bound_address
+            )
+            self.assertEqual(
+                render_job_queue.render(self._get_render_job_list(20)),
+                self._get_expected_pdf_tuple(20),
+            )
+            # The worker has been dropped before the queue is closed.
+            process.join(timeout=5)
+            self.assertEqual(process.exitcode, 0)
+
+    def test_template_mismatch_without_other_worker(self):
+        with pages_converters.RenderJobQueue(0, worker_timeout=5) as render_job_queue:
+            process = self._start_worker(
+                self.broken_directory, render_job_queue.bound_address
+            )
+            with self.assertRaises(pages_converters.NoRenderWorkerError):
+                render_job_queue.render(self._get_render_job_list(3))
+            # The worker has been dropped after its first job.
+            process.join(timeout=5)
+            self.assertEqual(process.exitcode, 0)
+
+    def test_worker_without_template_is_dropped(self):
+        with pages_converters.RenderJobQueue(1) as render_job_queue:
+            process = self._start_worker(
+                self.empty_directory, render_job_queue.bound_address
+            )
+            self.assertEqual(
+                render_job_queue.render(self._get_render_job_list(10)),
+                self._get_expected_pdf_tuple(10),
+            )
+            process.join(timeout=5)
+            self.assertEqual(process.exitcode, 0)
+
+    def test_failing_lualatex_drops_worker(self):
+        os.environ["FAKE_LUALATEX_FAIL"] = "1"
+        with self.assertRaises(pages_converters.NoRenderWorkerError):
+            pages_converters.RenderJobQueue(2, worker_timeout=5).render(
+                self._get_render_job_list(1)
+            )
+
+    def test_failing_job(self):
+        render_job = self._get_render_job_list(1)[0]
+        render_job.template_argument_dict["fail"] = True
+        with self.assertRaises(pages_converters.RenderJobError):
+            pages_converters.RenderJobQueue(2).render([render_job])
+
+
+if __name__ == "__main__":
+    unittest.main()